@@ -189,7 +189,7 @@ def nuke(args, api=None):
         api = kijiji_api.KijijiApi()
         api.login(args.username, args.password)
     all_ads = api.get_all_ads()
-    [api.delete_ad(ad['id']) for ad in all_ads]
+    api.delete_ads([ad['id'] for ad in all_ads])
 
 
 def generate_post_file(args):
@@ -1,11 +1,27 @@
 import json
 import re
 import sys
-from time import strftime
+from concurrent.futures import ThreadPoolExecutor
+from time import strftime, time
 from random import choice
-import bs4
 import requests
-import yaml
+from requests.adapters import HTTPAdapter, Retry
+
+try:
+    # Optional faster JSON parser; accepts bytes directly
+    import orjson as _json
+except ImportError:
+    import json as _json
+
+try:
+    # Optional faster html parser for scraping form tokens; lxml is used otherwise
+    from selectolax.lexbor import LexborHTMLParser as _HTMLParser
+except ImportError:
+    try:
+        # selectolax < 1.0 only ships the Modest backend
+        from selectolax.parser import HTMLParser as _HTMLParser
+    except ImportError:
+        _HTMLParser = None
 
 user_agents = [
     # Random list of top UAs for mac and windows/ chrome & FF
@@ -20,6 +36,43 @@ request_headers = {"User-Agent": session_ua}
 if sys.version_info < (3, 0):
     raise Exception("This program requires Python 3.0 or greater")
 
+# Patterns for data embedded in inline <script> tags, matched directly against the raw page html
+_WINDOW_DATA_RE = re.compile(r'window\.__data\s*=\s*(\{.*?\});\s*(?:</script>|$)', re.DOTALL | re.MULTILINE)
+# The config capture ends at the first '}', so only a flat config object (no nested objects) can be extracted
+_ZOOP_RE = re.compile(r'Zoop\.init\(.*?config:\s*({.+?})', re.DOTALL)
+_INITIAL_XSRF_RE = re.compile(r"initialXsrfToken: '(\S+)'")
+
+# Tokens of a JS object literal that may differ from JSON
+_JS_OBJECT_TOKEN_RE = re.compile(r"""
+    "(?:[^"\\]|\\.)*"                       # double quoted string, already valid JSON
+    |-?\d+(?:\.\d+)?(?:[eE][+-]?\d+)?       # number, already valid JSON
+    |'(?P<single>(?:[^'\\]|\\.)*)'          # single quoted string
+    |(?P<ident>[A-Za-z_$][\w$]*)            # bare key or unquoted value
+    |(?P<trailing>,)(?=\s*[}\]])            # trailing comma
+""", re.VERBOSE)
+_JSON_LITERALS = ('true', 'false', 'null')
+# Escape sequence or bare double quote inside a single quoted JS string
+_SINGLE_QUOTED_ESCAPE_RE = re.compile(r'\\(.)|"', re.DOTALL)
+
+# Ad ID returned in the set-cookie header after posting
+_KJRVA_RE = re.compile(r'kjrva=(\d+)')
+
+_IMAGE_UPLOAD_URL = 'https://www.kijiji.ca/p-upload-image.html'
+
+# Seconds that tokens scraped from the ad posting page are reused across posts
+_POST_TOKENS_TTL = 300
+
+
+def _retry_with_post(retry):
+    """
+    Return copy of Retry policy that also retries POST requests
+    urllib3 < 1.26 names the allowed methods option 'method_whitelist'
+    """
+    try:
+        return retry.new(allowed_methods=Retry.DEFAULT_ALLOWED_METHODS | {'POST'})
+    except (AttributeError, TypeError):
+        return retry.new(method_whitelist=Retry.DEFAULT_METHOD_WHITELIST | {'POST'})
+
 
 class KijijiApiException(Exception):
     """
@@ -40,15 +93,56 @@ class KijijiApiException(Exception):
             return self.msg
 
 
+def _search_from(pattern, text, prefix):
+    """
+    Return first match of compiled pattern at or after the first occurrence of its literal prefix, or None
+    A plain substring scan skips everything before the prefix much more cheaply than a regex search would
+    """
+    start = text.find(prefix)
+    if start < 0:
+        return None
+    return pattern.search(text, start)
+
+
 def get_token(html, attrib_name):
     """
     Return value of first match for element with name attribute
     """
-    soup = bs4.BeautifulSoup(html, 'html.parser')
-    res = soup.select("[name='{}']".format(attrib_name))
-    if not res:
-        raise KijijiApiException("Element with name attribute '{}' not found in html text.".format(attrib_name), html)
-    return res[0]['value']
+    return get_tokens(html, [attrib_name])[attrib_name]
+
+
+def get_tokens(html, attrib_names):
+    """
+    Return dict of values of first match for element with each name attribute
+    The html is parsed only once, no matter how many tokens are requested
+    """
+    if _HTMLParser is not None:
+        tree = _HTMLParser(html)
+
+        def find_value(attrib_name):
+            # Quote the name as a CSS string so it can't alter the selector
+            quoted_name = '"' + attrib_name.replace('\\', '\\\\').replace('"', '\\"') + '"'
+            node = tree.css_first('[name=' + quoted_name + '][value]')
+            if node is None:
+                return None
+            # A bare 'value' attribute has no value; lxml reports it as an empty string
+            return node.attributes['value'] or ''
+    else:
+        # Imported here so callers that never scrape form tokens don't pay lxml's import cost
+        import lxml.html
+        root = lxml.html.fromstring(html)
+
+        def find_value(attrib_name):
+            res = root.xpath('//*[@name=$name]/@value', name=attrib_name)
+            return res[0] if res else None
+
+    tokens = {}
+    for attrib_name in attrib_names:
+        value = find_value(attrib_name)
+        if value is None:
+            raise KijijiApiException("Element with name attribute '{}' not found in html text.".format(attrib_name), html)
+        tokens[attrib_name] = value
+    return tokens
 
 
 def get_kj_data(html):
@@ -56,31 +150,50 @@ def get_kj_data(html):
     Return dict of Kijiji page data
     The 'window.__data' JSON object contains many useful key/values
     """
-    soup = bs4.BeautifulSoup(html, 'html.parser')
-    p = re.compile(r'window\.__data=(.*);')
-    script_list = soup.find_all("script", {"src": False})
-    for script in script_list:
-        if script:
-            m = p.search(script.string)
-            if m:
-                return json.loads(m.group(1))
+    m = _search_from(_WINDOW_DATA_RE, html, 'window.__data')
+    if m:
+        try:
+            return _json.loads(m.group(1))
+        except ValueError:
+            raise KijijiApiException("Could not parse '__data' JSON object in html text.", html)
     raise KijijiApiException("'__data' JSON object not found in html text.", html)
 
 
+def js_object_to_json(js_object):
+    """
+    Convert a simple JS object literal into valid JSON text
+    Handles bare keys, single quoted strings, unquoted identifier values and trailing commas
+    """
+    def single_quoted_escape(m):
+        # \' is not a valid JSON escape, other escapes are kept as is, and bare " must be escaped
+        if m.group(1) is None:
+            return '\\"'
+        return "'" if m.group(1) == "'" else m.group(0)
+
+    def repl(m):
+        if m.group('single') is not None:
+            return '"{}"'.format(_SINGLE_QUOTED_ESCAPE_RE.sub(single_quoted_escape, m.group('single')))
+        if m.group('ident') is not None and m.group('ident') not in _JSON_LITERALS:
+            return '"{}"'.format(m.group('ident'))
+        if m.group('trailing') is not None:
+            return ''
+        return m.group(0)
+    return _JS_OBJECT_TOKEN_RE.sub(repl, js_object)
+
+
 def get_xsrf_token(html):
     """
     Return XSRF token
     This function is only necessary for the 'm-my-ads.html' page, as this particular page
     does not contain the usual 'ca.kijiji.xsrf.token' hidden HTML form input element, which is easier to scrape
     """
-    soup = bs4.BeautifulSoup(html, 'html.parser')
-    p = re.compile(r'Zoop\.init\(.*config: ({.+?}).*\);')
-    for script in soup.find_all("script", {"src": False}):
-        if script:
-            m = p.search(script.string.replace("\n", ""))
-            if m:
-                # Using yaml to load since this is not valid JSON
-                return yaml.load(m.group(1), Loader=yaml.FullLoader)['token']
+    m = _search_from(_ZOOP_RE, html, 'Zoop.init(')
+    if m:
+        # Config is a JS object literal rather than valid JSON
+        try:
+            return _json.loads(js_object_to_json(m.group(1)))['token']
+        except (KeyError, ValueError):
+            raise KijijiApiException("Could not parse XSRF token from Zoop config.", html)
     raise KijijiApiException("XSRF token not found in html text.", html)
 
 
@@ -91,11 +204,24 @@ class KijijiApi:
     def __init__(self):
         config = {}
         self.session = requests.Session()
+        # Larger keep-alive pool so concurrent image uploads don't contend for connections,
+        # with transparent exponential backoff retries on throttling and transient gateway errors
+        retry = Retry(total=3, backoff_factor=0.5, status_forcelist=[429, 502, 503, 504], raise_on_status=False)
+        self.session.mount('https://', HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=retry))
+        # Image uploads are safe to repeat, so POSTs to that endpoint are retried as well;
+        # other POSTs (eg. submitting an ad) are not, to avoid duplicate side effects
+        upload_retry = _retry_with_post(retry)
+        self.session.mount(_IMAGE_UPLOAD_URL, HTTPAdapter(pool_connections=32, pool_maxsize=32, max_retries=upload_retry))
+        self._xsrf_token = None
+        self._post_tokens = None
+        self._post_tokens_ts = 0
 
     def login(self, username, password):
         """
         Login to Kijiji for the current session
         """
+        self._xsrf_token = None
+        self._post_tokens = None
         login_url = 'https://www.kijiji.ca/t-login.html'
         resp = self.session.get(login_url, headers=request_headers)
         payload = {
@@ -124,41 +250,74 @@ class KijijiApi:
         """
         Return true if logged into Kijiji for the current session
         """
-        resp = self.session.get('https://www.kijiji.ca/my/ads.json', headers=request_headers)
-        try:
-            resp.json()
+        # Cheap check first: a HEAD request avoids downloading the full ads listing
+        resp = self.session.head('https://www.kijiji.ca/my/ads.json', headers=request_headers, allow_redirects=False)
+        if resp.status_code == 200 and 'json' in resp.headers.get('Content-Type', ''):
             return True
-        except:
+        if resp.is_redirect or resp.status_code in (401, 403):
             return False
 
+        # Inconclusive, fall back to a GET, but stream it: the start of the body is enough
+        # to tell the JSON ads listing apart from an html login page
+        with self.session.get('https://www.kijiji.ca/my/ads.json', headers=request_headers, stream=True) as resp:
+            head = next(resp.iter_content(512), b'')
+        return head.lstrip().startswith(b'{')
+
     def logout(self):
         """
         Logout of Kijiji for the current session
         """
         self.session.get('https://www.kijiji.ca/m-logout.html',  headers=request_headers)
+        self._xsrf_token = None
+        self._post_tokens = None
 
     def delete_ad(self, ad_id):
         """
         Delete ad based on ad ID
         """
-        my_ads_page = self.session.get('https://www.kijiji.ca/m-my-ads.html',  headers=request_headers)
-        params = {
-            'Action': 'DELETE_ADS',
-            'Mode': 'ACTIVE',
-            'needsRedirect': 'false',
-            'ads': '[{{"adId":"{}","reason":"PREFER_NOT_TO_SAY","otherReason":""}}]'.format(ad_id),
-            'ca.kijiji.xsrf.token': get_xsrf_token(my_ads_page.text),
-        }
-        resp = self.session.post('https://www.kijiji.ca/j-delete-ad.json', data=params,  headers=request_headers)
-        if "OK" not in resp.text:
-            raise KijijiApiException("Could not delete ad.", resp.text)
+        self.delete_ads([ad_id])
+
+    def delete_ads(self, ad_ids):
+        """
+        Delete multiple ads based on ad IDs in a single request
+        """
+        if not ad_ids:
+            return
+        ads = json.dumps([{"adId": str(ad_id), "reason": "PREFER_NOT_TO_SAY", "otherReason": ""} for ad_id in ad_ids])
+        for _ in range(0, 2):
+            reusing_token = self._xsrf_token is not None
+            params = {
+                'Action': 'DELETE_ADS',
+                'Mode': 'ACTIVE',
+                'needsRedirect': 'false',
+                'ads': ads,
+                'ca.kijiji.xsrf.token': self._get_session_xsrf(),
+            }
+            resp = self.session.post('https://www.kijiji.ca/j-delete-ad.json', data=params,  headers=request_headers)
+            if resp.ok and b"OK" in resp.content:
+                return
+            # Token may be stale; never reuse it after a failed delete
+            self._xsrf_token = None
+            # Only HTTP errors with a cached token are retried, with a freshly scraped one
+            if resp.ok or not reusing_token:
+                break
+        raise KijijiApiException("Could not delete ad.", resp.text)
+
+    def _get_session_xsrf(self):
+        """
+        Return XSRF token for the current session, scraping it from 'm-my-ads.html' only on first use
+        """
+        if self._xsrf_token is None:
+            my_ads_page = self.session.get('https://www.kijiji.ca/m-my-ads.html',  headers=request_headers)
+            self._xsrf_token = get_xsrf_token(my_ads_page.text)
+        return self._xsrf_token
 
     def delete_ad_using_title(self, title):
         """
         Delete ad based on ad title
         """
         all_ads = self.get_all_ads()
-        [self.delete_ad(ad['id']) for ad in all_ads if ad['title'].strip() == title.strip()]
+        self.delete_ads([ad['id'] for ad in all_ads if ad['title'].strip() == title.strip()])
 
     def upload_image(self, token, image_files=[]):
         """
@@ -166,27 +325,33 @@ class KijijiApi:
 
         'image_files' is a list of binary objects corresponding to images
         """
-        image_urls = []
-        image_upload_url = 'https://www.kijiji.ca/p-upload-image.html'
-        for img_file in image_files:
-            for i in range(0, 3):
-                r = self.session.post(
-                    image_upload_url, 
-                    files={'file': img_file}, 
-                    headers={
-                        "X-Ebay-Box-Token": token,
-                        "User-Agent": session_ua})
-                r.raise_for_status()
-                try:
-                    image_tree = json.loads(r.text)
-                    img_url = image_tree['thumbnailUrl']
-                    print("Image upload success on try #{}".format(i+1))
-                    image_urls.append(img_url)
-                    break
-                except (KeyError, ValueError):
-                    print("Image upload failed on try #{}".format(i+1))
+        if not image_files:
+            return []
+        # Uploads are network bound, so send them concurrently over the shared session
+        with ThreadPoolExecutor(max_workers=min(8, len(image_files))) as executor:
+            image_urls = list(executor.map(lambda img_file: self._upload_one_image(token, img_file), image_files))
         return [image for image in image_urls if image is not None]
 
+    def _upload_one_image(self, token, img_file):
+        """
+        Upload a single photo to Kijiji
+
+        Transient failures are retried with backoff by the session's adapter
+        Return the uploaded image URL, or None if the response did not contain one
+        """
+        r = self.session.post(
+            _IMAGE_UPLOAD_URL,
+            files={'file': img_file},
+            headers={
+                "X-Ebay-Box-Token": token,
+                "User-Agent": session_ua})
+        r.raise_for_status()
+        try:
+            return _json.loads(r.content)['thumbnailUrl']
+        except (KeyError, ValueError):
+            print("Image upload failed")
+            return None
+
     def post_ad_using_data(self, data, image_files=[]):
         """
         Post new ad
@@ -194,24 +359,6 @@ class KijijiApi:
         'data' is a dictionary of ad data that to be posted
         'image_files' is a list of binary objects corresponding to images to upload
         """
-        # Load ad posting page (arbitrary category)
-        resp = self.session.get('https://www.kijiji.ca/p-admarkt-post-ad.html?categoryId=15', headers=request_headers)
-
-        # Get token required for upload
-        m = re.search(r"initialXsrfToken: '(\S+)'", resp.text)
-        if m:
-            image_upload_token = m.group(1)
-        else:
-            raise KijijiApiException("'initialXsrfToken' not found in html text.", resp.text)
-
-        # Upload the images
-        image_list = self.upload_image(image_upload_token, image_files)
-        data['images'] = ",".join(image_list)
-
-        # Retrieve XSRF tokens
-        data['ca.kijiji.xsrf.token'] = get_token(resp.text, 'ca.kijiji.xsrf.token')
-        data['postAdForm.fraudToken'] = get_token(resp.text, 'postAdForm.fraudToken')
-
         # Select basic package and confirm terms
         data['postAdForm.confirmedTerms'] = True
         data['featuresForm.featurePackage'] = "PKG_BASIC"
@@ -224,20 +371,86 @@ class KijijiApi:
         if title_len > 64:
             raise KijijiApiException("Your ad title is too long! (max 64 chars)")
 
+        reusing_tokens = self._post_tokens is not None and time() - self._post_tokens_ts < _POST_TOKENS_TTL
+        tokens = self._get_post_tokens()
+
+        # Upload the images
+        try:
+            image_list = self.upload_image(tokens['initialXsrfToken'], image_files)
+        except requests.HTTPError:
+            self._post_tokens = None
+            if not reusing_tokens:
+                raise
+            # Cached upload token may have expired; scrape fresh tokens and try once more
+            reusing_tokens = False
+            tokens = self._get_post_tokens()
+            image_list = self.upload_image(tokens['initialXsrfToken'], image_files)
+        data['images'] = ",".join(image_list)
+
         # Upload the ad itself
-        new_ad_url = "https://www.kijiji.ca/p-submit-ad.html"
-        resp = self.session.post(new_ad_url, data=data, headers=request_headers)
-        resp.raise_for_status()
-        if "deleteWithoutSurvey" not in resp.text:
-            if "There was an issue posting your ad, please contact Customer Service." in resp.text:
+        while True:
+            try:
+                resp = self._submit_ad(data, tokens)
+                break
+            except requests.HTTPError:
+                self._post_tokens = None
+                if not reusing_tokens:
+                    raise
+                # Cached tokens may have expired; the images are already uploaded, so only resubmit the form.
+                # Other failures are not resubmitted, since the ad may have been posted anyway
+                reusing_tokens = False
+                tokens = self._get_post_tokens()
+
+        if b"deleteWithoutSurvey" not in resp.content:
+            # Tokens may be already used up, so they are never reused after a failed post
+            self._post_tokens = None
+            if b"There was an issue posting your ad, please contact Customer Service." in resp.content:
                 raise KijijiApiException("Could not post ad; this user is banned.", resp.text)
             else:
                 raise KijijiApiException("Could not post ad.", resp.text)
 
         # Extract ad ID from response set-cookie
-        ad_id = re.search('kjrva=(\d+)', resp.headers['Set-Cookie']).group(1)
+        m = _search_from(_KJRVA_RE, resp.headers.get('Set-Cookie', ''), 'kjrva=')
+        if not m:
+            self._post_tokens = None
+            raise KijijiApiException("Ad ID not found in response cookies.")
+
+        return m.group(1)
 
-        return ad_id
+    def _get_post_tokens(self):
+        """
+        Return dict of tokens scraped from the ad posting page, reloading the page only once the cached tokens are stale
+        """
+        if self._post_tokens is None or time() - self._post_tokens_ts >= _POST_TOKENS_TTL:
+            # Load ad posting page (arbitrary category)
+            resp = self.session.get('https://www.kijiji.ca/p-admarkt-post-ad.html?categoryId=15', headers=request_headers)
+            html = resp.text
+
+            # Get token required for upload
+            m = _search_from(_INITIAL_XSRF_RE, html, 'initialXsrfToken:')
+            if not m:
+                raise KijijiApiException("'initialXsrfToken' not found in html text.", html)
+
+            # Retrieve XSRF tokens
+            tokens = get_tokens(html, ['ca.kijiji.xsrf.token', 'postAdForm.fraudToken'])
+            tokens['initialXsrfToken'] = m.group(1)
+            self._post_tokens = tokens
+            self._post_tokens_ts = time()
+        return self._post_tokens
+
+    def _submit_ad(self, data, tokens):
+        """
+        Submit the ad form using the given ad posting page tokens
+
+        Return the response; raise requests.HTTPError on HTTP failure
+        """
+        data['ca.kijiji.xsrf.token'] = tokens['ca.kijiji.xsrf.token']
+        data['postAdForm.fraudToken'] = tokens['postAdForm.fraudToken']
+
+        new_ad_url = "https://www.kijiji.ca/p-submit-ad.html"
+        resp = self.session.post(new_ad_url, data=data, headers=request_headers)
+        resp.raise_for_status()
+        return resp
 
     def get_all_ads(self):
         """
@@ -245,7 +458,7 @@ class KijijiApi:
         """
         resp = self.session.get('https://www.kijiji.ca/my/ads.json', headers=request_headers)
         resp.raise_for_status()
-        ads_json = json.loads(resp.text)
+        ads_json = _json.loads(resp.content)
         ads_info = ads_json['ads']
 
         if ads_info:
@@ -255,10 +468,10 @@ class KijijiApi:
             params = [("ids", ad['id']) for ad in ads_info.values()]
             resp = self.session.get('https://www.kijiji.ca/my/ranks', params=params, headers=request_headers)
             resp.raise_for_status()
-            ranks_json = json.loads(resp.text)
+            ranks_json = _json.loads(resp.content)
 
             # Add ranks to existing ad properties dict
             for ad_id, rank in ranks_json['ranks'].items():
                 ads_info[ad_id]['rank'] = rank
 
-        return [ad for ad in ads_info.values()]
+        return list(ads_info.values())
@@ -0,0 +1,424 @@
+import json
+import os
+import tempfile
+import threading
+from unittest import TestCase, mock, skipUnless
+
+import requests
+
+from kijiji_repost_headless import kijiji_api
+from kijiji_repost_headless.kijiji_api import KijijiApi, KijijiApiException, get_kj_data, get_tokens, get_xsrf_token, js_object_to_json
+
+
+class DumpDirTestCase(TestCase):
+    """
+    Run each test in a temporary directory, since KijijiApiException writes html dump files to the cwd
+    """
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        os.chdir(self.tmpdir.name)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        self.tmpdir.cleanup()
+
+
+class TestsJsObjectToJson(TestCase):
+
+    def test_bare_keys(self):
+        self.assertEqual(json.loads(js_object_to_json('{token: "abc", $id: 5, _x: true}')),
+                         {"token": "abc", "$id": 5, "_x": True})
+
+    def test_single_quoted_strings(self):
+        self.assertEqual(json.loads(js_object_to_json(r"""{a: 'it\'s', b: 'say "hi"', c: 'x:y,z'}""")),
+                         {"a": "it's", "b": 'say "hi"', "c": "x:y,z"})
+        self.assertEqual(json.loads(js_object_to_json(r"""{a: 'say \"hi\"', b: 'tab\there', c: 'back\\slash'}""")),
+                         {"a": 'say "hi"', "b": "tab\there", "c": "back\\slash"})
+
+    def test_double_quoted_strings_untouched(self):
+        self.assertEqual(json.loads(js_object_to_json('{a: "k: v, w", "b": "it\'s"}')),
+                         {"a": "k: v, w", "b": "it's"})
+
+    def test_unquoted_values_and_literals(self):
+        self.assertEqual(json.loads(js_object_to_json("{locale: en_CA, on: false, none: null, n: -1.5e3}")),
+                         {"locale": "en_CA", "on": False, "none": None, "n": -1500})
+
+    def test_trailing_commas(self):
+        self.assertEqual(json.loads(js_object_to_json("{a: [1, 2,], b: {c: 'd',},}")),
+                         {"a": [1, 2], "b": {"c": "d"}})
+
+
+class TestsGetKjData(DumpDirTestCase):
+
+    def test_single_line_script(self):
+        self.assertEqual(get_kj_data('<script>window.__data={"a":{"b":1}};</script>'), {"a": {"b": 1}})
+
+    def test_statement_after_data_on_next_line(self):
+        html = '<script>window.__data={"a":1};\nwindow.x={};</script>'
+        self.assertEqual(get_kj_data(html), {"a": 1})
+
+    def test_earlier_non_matching_reference(self):
+        html = '<script>if(window.__data){}</script><script>window.__data={"a":1};</script>'
+        self.assertEqual(get_kj_data(html), {"a": 1})
+
+    def test_missing_data_raises(self):
+        with self.assertRaises(KijijiApiException):
+            get_kj_data('<script>window.x={};</script>')
+
+
+class TestsGetXsrfToken(DumpDirTestCase):
+
+    def test_multi_line_zoop_config(self):
+        html = ("<script>\nZoop.init({\n  env: 'prod',\n  config: {\n    token: '1a2b3c',\n"
+                "    locale: 'en_CA'\n  }\n});\n</script>")
+        self.assertEqual(get_xsrf_token(html), "1a2b3c")
+
+    def test_unparsable_config_raises(self):
+        with self.assertRaises(KijijiApiException):
+            get_xsrf_token("<script>Zoop.init({config: {token: 'abc' 'def'}});</script>")
+
+    def test_missing_token_raises(self):
+        with self.assertRaises(KijijiApiException):
+            get_xsrf_token("<script>Zoop.init({config: {locale: 'en_CA'}});</script>")
+
+
+class TestsKijijiApiSession(TestCase):
+
+    def test_only_image_uploads_retry_post(self):
+        session = KijijiApi().session
+        self.assertIn('POST', session.get_adapter('https://www.kijiji.ca/p-upload-image.html').max_retries.allowed_methods)
+        self.assertNotIn('POST', session.get_adapter('https://www.kijiji.ca/p-submit-ad.html').max_retries.allowed_methods)
+
+
+MY_ADS_HTML = "<script>Zoop.init({config: {token: 'xsrf-1'}});</script>"
+
+
+def fake_response(content=b"", status_code=200, headers=None):
+    resp = mock.Mock()
+    resp.content = content
+    resp.text = content.decode()
+    resp.status_code = status_code
+    resp.ok = status_code < 400
+    resp.headers = headers or {}
+    resp.is_redirect = status_code in (301, 302, 303, 307, 308)
+    if not resp.ok:
+        resp.raise_for_status.side_effect = requests.HTTPError(response=resp)
+    return resp
+
+
+def streamed_response(chunks):
+    """
+    Return mock of a streamed response, usable as a context manager, yielding the given body chunks
+    """
+    resp = mock.MagicMock()
+    resp.__enter__.return_value = resp
+    resp.consumed = []
+
+    def iter_content(chunk_size=1, decode_unicode=False):
+        for chunk in chunks:
+            resp.consumed.append(chunk)
+            yield chunk
+    resp.iter_content.side_effect = iter_content
+    return resp
+
+
+class TestsDeleteAds(DumpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api = KijijiApi()
+        self.api.session = mock.Mock()
+        self.api.session.get.return_value = fake_response(MY_ADS_HTML.encode())
+        self.api.session.post.return_value = fake_response(b'{"status":"OK"}')
+
+    def test_single_post_for_all_ads(self):
+        self.api.delete_ads([123, "456"])
+        self.assertEqual(self.api.session.post.call_count, 1)
+        params = self.api.session.post.call_args[1]['data']
+        self.assertEqual(json.loads(params['ads']), [
+            {"adId": "123", "reason": "PREFER_NOT_TO_SAY", "otherReason": ""},
+            {"adId": "456", "reason": "PREFER_NOT_TO_SAY", "otherReason": ""},
+        ])
+        self.assertEqual(params['ca.kijiji.xsrf.token'], 'xsrf-1')
+
+    def test_delete_using_title_deletes_matching_ads(self):
+        ads = [{'id': '1', 'title': 'Bike '}, {'id': '2', 'title': 'Desk'}, {'id': '3', 'title': 'Bike'}]
+        with mock.patch.object(self.api, 'get_all_ads', return_value=ads):
+            self.api.delete_ad_using_title('Bike')
+        self.assertEqual(self.api.session.post.call_count, 1)
+        ads_param = json.loads(self.api.session.post.call_args[1]['data']['ads'])
+        self.assertEqual([ad['adId'] for ad in ads_param], ['1', '3'])
+
+    def test_delete_using_title_without_matches_makes_no_requests(self):
+        with mock.patch.object(self.api, 'get_all_ads', return_value=[{'id': '1', 'title': 'Desk'}]):
+            self.api.delete_ad_using_title('Bike')
+        self.api.session.get.assert_not_called()
+        self.api.session.post.assert_not_called()
+
+    def test_cached_token_refreshed_once_on_http_error(self):
+        self.api._xsrf_token = 'stale'
+        self.api.session.post.side_effect = [fake_response(b'', 403), fake_response(b'{"status":"OK"}')]
+        self.api.delete_ads(['1'])
+        self.assertEqual(self.api.session.get.call_count, 1)
+        tokens = [c[1]['data']['ca.kijiji.xsrf.token'] for c in self.api.session.post.call_args_list]
+        self.assertEqual(tokens, ['stale', 'xsrf-1'])
+
+    def test_fresh_token_not_retried_on_http_error(self):
+        self.api.session.post.return_value = fake_response(b'', 403)
+        with self.assertRaises(KijijiApiException):
+            self.api.delete_ads(['1'])
+        self.assertEqual(self.api.session.post.call_count, 1)
+        self.assertIsNone(self.api._xsrf_token)
+
+    def test_failed_delete_body_not_retried(self):
+        self.api._xsrf_token = 'cached'
+        self.api.session.post.return_value = fake_response(b'{"status":"ERROR"}')
+        with self.assertRaises(KijijiApiException):
+            self.api.delete_ads(['1'])
+        self.assertEqual(self.api.session.post.call_count, 1)
+        self.api.session.get.assert_not_called()
+        self.assertIsNone(self.api._xsrf_token)
+
+
+POST_AD_HTML = ("<script>initialXsrfToken: 'upload-{0}'</script><form>"
+                "<input type='hidden' name='ca.kijiji.xsrf.token' value='xsrf-{0}'>"
+                "<input type='hidden' name='postAdForm.fraudToken' value='fraud-{0}'></form>")
+POSTED = fake_response(b"<a>deleteWithoutSurvey</a>", headers={'Set-Cookie': 'kjrva=x; Path=/, kjrva=42; Path=/'})
+REJECTED = fake_response(b"<p>Something went wrong</p>")
+BANNED = fake_response(b"There was an issue posting your ad, please contact Customer Service.")
+
+
+class TestsPostAdTokens(DumpDirTestCase):
+
+    def setUp(self):
+        super().setUp()
+        self.api = KijijiApi()
+        self.api.session = mock.Mock()
+        self.api.session.get.side_effect = [fake_response(POST_AD_HTML.format(i).encode()) for i in range(1, 4)]
+        self.now = 1000.0
+        patcher = mock.patch('kijiji_repost_headless.kijiji_api.time', side_effect=lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = mock.patch.object(self.api, 'upload_image', return_value=['http://img/1.jpg'])
+        self.upload_image = patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def post(self):
+        data = {'postAdForm.title': 'A bicycle for sale', 'postAdForm.description': 'Red\\nFast'}
+        return self.api.post_ad_using_data(data, [b'img']), data
+
+    def respond(self, *responses):
+        # Record the fraud token at call time, since a retry resubmits the same (mutated) data dict
+        self.fraud_tokens = []
+        responses = iter(responses)
+
+        def post(url, data=None, **kwargs):
+            self.fraud_tokens.append(data['postAdForm.fraudToken'])
+            return next(responses)
+        self.api.session.post.side_effect = post
+
+    def test_tokens_reused_within_ttl(self):
+        self.respond(POSTED, POSTED)
+        ad_id, data = self.post()
+        self.assertEqual(ad_id, '42')
+        self.assertEqual(data['images'], 'http://img/1.jpg')
+        self.now += 299
+        self.post()
+        self.assertEqual(self.api.session.get.call_count, 1)
+        self.assertEqual(self.fraud_tokens, ['fraud-1', 'fraud-1'])
+
+    def test_tokens_refreshed_after_ttl(self):
+        self.respond(POSTED, POSTED)
+        self.post()
+        self.now += 300
+        self.post()
+        self.assertEqual(self.api.session.get.call_count, 2)
+        self.assertEqual(self.fraud_tokens, ['fraud-1', 'fraud-2'])
+
+    def test_fresh_tokens_invalidated_after_rejected_post(self):
+        self.respond(REJECTED, POSTED)
+        with self.assertRaises(KijijiApiException):
+            self.post()
+        self.assertIsNone(self.api._post_tokens)
+        self.post()
+        self.assertEqual(self.fraud_tokens, ['fraud-1', 'fraud-2'])
+
+    def test_cached_tokens_not_resubmitted_after_rejected_post(self):
+        self.respond(POSTED, REJECTED, POSTED)
+        self.post()
+        with self.assertRaises(KijijiApiException):
+            self.post()
+        self.assertEqual(self.fraud_tokens, ['fraud-1', 'fraud-1'])
+        self.assertIsNone(self.api._post_tokens)
+
+    def test_cached_tokens_resubmitted_after_http_error(self):
+        self.respond(POSTED, fake_response(status_code=403), POSTED)
+        self.post()
+        self.upload_image.reset_mock()
+        ad_id, _ = self.post()
+        self.assertEqual(ad_id, '42')
+        self.assertEqual(self.fraud_tokens, ['fraud-1', 'fraud-1', 'fraud-2'])
+        # Images uploaded with the cached tokens are not uploaded again
+        self.upload_image.assert_called_once_with('upload-1', [b'img'])
+
+    def test_resubmission_after_http_error_happens_only_once(self):
+        self.respond(POSTED, fake_response(status_code=403), REJECTED)
+        self.post()
+        with self.assertRaises(KijijiApiException):
+            self.post()
+        self.assertEqual(self.fraud_tokens, ['fraud-1', 'fraud-1', 'fraud-2'])
+        self.assertIsNone(self.api._post_tokens)
+
+    def test_banned_user_not_retried(self):
+        self.respond(POSTED, BANNED)
+        self.post()
+        with self.assertRaises(KijijiApiException):
+            self.post()
+        self.assertEqual(self.api.session.post.call_count, 2)
+        self.assertIsNone(self.api._post_tokens)
+
+    def test_failed_upload_with_cached_tokens_refreshes_tokens(self):
+        self.respond(POSTED, POSTED)
+        self.post()
+        self.upload_image.side_effect = [requests.HTTPError(), ['http://img/2.jpg']]
+        _, data = self.post()
+        self.assertEqual(data['images'], 'http://img/2.jpg')
+        self.assertEqual([c[0][0] for c in self.upload_image.call_args_list[-2:]], ['upload-1', 'upload-2'])
+
+
+class TestsGetTokens(DumpDirTestCase):
+
+    def get_tokens_with_each_backend(self, html, attrib_names):
+        """
+        Return results from the selectolax backend and the lxml fallback
+        """
+        results = [get_tokens(html, attrib_names)]
+        with mock.patch.object(kijiji_api, '_HTMLParser', None):
+            results.append(get_tokens(html, attrib_names))
+        return results
+
+    def test_lxml_post_ad_page(self):
+        with mock.patch.object(kijiji_api, '_HTMLParser', None):
+            self.assertEqual(get_tokens(POST_AD_HTML.format(1), ['ca.kijiji.xsrf.token', 'postAdForm.fraudToken']),
+                             {'ca.kijiji.xsrf.token': 'xsrf-1', 'postAdForm.fraudToken': 'fraud-1'})
+
+    def test_lxml_missing_token_raises(self):
+        with mock.patch.object(kijiji_api, '_HTMLParser', None):
+            with self.assertRaises(KijijiApiException):
+                get_tokens(POST_AD_HTML.format(1), ['missing'])
+
+    @skipUnless(kijiji_api._HTMLParser, "selectolax is not installed")
+    def test_backends_agree_on_post_ad_page(self):
+        names = ['ca.kijiji.xsrf.token', 'postAdForm.fraudToken']
+        for tokens in self.get_tokens_with_each_backend(POST_AD_HTML.format(1), names):
+            self.assertEqual(tokens, {'ca.kijiji.xsrf.token': 'xsrf-1', 'postAdForm.fraudToken': 'fraud-1'})
+
+    @skipUnless(kijiji_api._HTMLParser, "selectolax is not installed")
+    def test_backends_agree_on_bare_value(self):
+        for tokens in self.get_tokens_with_each_backend("<input name='token' value>", ['token']):
+            self.assertEqual(tokens, {'token': ''})
+
+    @skipUnless(kijiji_api._HTMLParser, "selectolax is not installed")
+    def test_backends_agree_on_quotes_in_name(self):
+        html = """<input name='a"] [name="b' value='wrong'><input name='a\\"b' value='right'>"""
+        for tokens in self.get_tokens_with_each_backend(html, ['a\\"b']):
+            self.assertEqual(tokens, {'a\\"b': 'right'})
+
+
+class TestsIsLoggedIn(TestCase):
+
+    def setUp(self):
+        self.api = KijijiApi()
+        self.api.session = mock.Mock()
+
+    def head(self, status_code, content_type=''):
+        self.api.session.head.return_value = fake_response(status_code=status_code, headers={'Content-Type': content_type})
+
+    def test_head_json_response_is_logged_in(self):
+        self.head(200, 'application/json;charset=UTF-8')
+        self.assertTrue(self.api.is_logged_in())
+        self.assertFalse(self.api.session.head.call_args[1]['allow_redirects'])
+        self.api.session.get.assert_not_called()
+
+    def test_head_redirect_is_logged_out(self):
+        self.head(302)
+        self.assertFalse(self.api.is_logged_in())
+        self.api.session.get.assert_not_called()
+
+    def test_head_unauthorized_is_logged_out(self):
+        for status_code in (401, 403):
+            self.head(status_code)
+            self.assertFalse(self.api.is_logged_in())
+        self.api.session.get.assert_not_called()
+
+    def test_inconclusive_head_falls_back_to_get(self):
+        for status_code, content_type in ((200, 'text/html'), (405, '')):
+            self.api.session.get.reset_mock()
+            self.head(status_code, content_type)
+            self.api.session.get.return_value = streamed_response([b'{"ads": {}}'])
+            self.assertTrue(self.api.is_logged_in())
+            self.api.session.get.assert_called_once()
+
+    def fallback(self, *chunks):
+        self.head(405)
+        resp = streamed_response(chunks)
+        self.api.session.get.return_value = resp
+        return self.api.is_logged_in(), resp
+
+    def test_fallback_json_body_is_logged_in(self):
+        logged_in, resp = self.fallback(b'  \n{"ads": {', b'"1": {}}}')
+        self.assertTrue(logged_in)
+        self.assertTrue(self.api.session.get.call_args[1]['stream'])
+
+    def test_fallback_html_body_is_logged_out(self):
+        for body in (b'<!DOCTYPE html><html>', b'\r\n  <html><title>Sign In</title>'):
+            logged_in, _ = self.fallback(body, b'</html>')
+            self.assertFalse(logged_in)
+
+    def test_fallback_reads_only_first_chunk_and_closes(self):
+        _, resp = self.fallback(b'{"ads": {', b'"1": {}', b'}}')
+        self.assertEqual(resp.consumed, [b'{"ads": {'])
+        resp.__exit__.assert_called_once()
+
+
+class TestsUploadImage(TestCase):
+
+    def setUp(self):
+        self.api = KijijiApi()
+        self.api.session = mock.Mock()
+        self.second_done = threading.Event()
+
+        def post(url, files=None, **kwargs):
+            img = files['file']
+            if img == b'first':
+                # Finish after the second upload, so results complete out of order
+                self.second_done.wait(5)
+                return fake_response(b'{"thumbnailUrl": "http://img/first.jpg"}')
+            if img == b'second':
+                self.second_done.set()
+                return fake_response(b'{"thumbnailUrl": "http://img/second.jpg"}')
+            if img == b'broken':
+                return fake_response(status_code=500)
+            return fake_response(b'{"error": "no thumbnail"}')
+        self.api.session.post.side_effect = post
+
+    def test_results_follow_image_order(self):
+        self.assertEqual(self.api.upload_image('token', [b'first', b'second']),
+                         ['http://img/first.jpg', 'http://img/second.jpg'])
+        self.assertEqual(self.api.session.post.call_args[1]['headers']['X-Ebay-Box-Token'], 'token')
+
+    def test_uploads_without_thumbnail_are_skipped(self):
+        with mock.patch('builtins.print'):
+            self.assertEqual(self.api.upload_image('token', [b'first', b'no-thumbnail', b'second']),
+                             ['http://img/first.jpg', 'http://img/second.jpg'])
+
+    def test_http_error_reaches_caller(self):
+        self.second_done.set()
+        with self.assertRaises(requests.HTTPError):
+            self.api.upload_image('token', [b'first', b'broken'])
+
+    def test_no_images(self):
+        self.assertEqual(self.api.upload_image('token', []), [])
+        self.api.session.post.assert_not_called()